@@ -1,10 +1,20 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import re
 import base64
+import hashlib
+import html
 from PIL import Image
 import io
+import threading
+import time
+from string import Template
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
 # ----------------------------------
 # Page Configuration
@@ -19,14 +29,23 @@ st.set_page_config(
 # ----------------------------------
 # Custom CSS
 # ----------------------------------
-st.markdown("""
+CSS = """
 <style>
+    :root {
+        --leaf-dark: #2d5016;
+        --leaf-darker: #1a3409;
+        --leaf: #56ab2f;
+        --leaf-light: #a8e063;
+        --text: #333333;
+        --text-muted: #555555;
+    }
+    
     .main {
         background: linear-gradient(135deg, #f5f7fa 0%, #c3cfe2 100%);
     }
     
     [data-testid="stSidebar"] {
-        background: linear-gradient(180deg, #2d5016 0%, #1a3409 100%);
+        background: linear-gradient(180deg, var(--leaf-dark) 0%, var(--leaf-darker) 100%);
     }
     
     [data-testid="stSidebar"] * {
@@ -34,7 +53,7 @@ st.markdown("""
     }
     
     h1 {
-        color: #2d5016;
+        color: var(--leaf-dark);
         font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
         font-weight: 700;
         text-align: center;
@@ -42,7 +61,7 @@ st.markdown("""
     }
     
     .stButton>button {
-        background: linear-gradient(90deg, #56ab2f 0%, #a8e063 100%);
+        background: linear-gradient(90deg, var(--leaf) 0%, var(--leaf-light) 100%);
         color: white;
         border: none;
         padding: 15px 40px;
@@ -59,106 +78,77 @@ st.markdown("""
         box-shadow: 0 6px 20px rgba(86, 171, 47, 0.6);
     }
     
-    .result-card {
+    .result-card, .feature-card {
         background: white;
+        color: var(--text);
+    }
+    
+    .result-card {
         padding: 25px;
         border-radius: 15px;
         box-shadow: 0 4px 15px rgba(0,0,0,0.1);
         margin: 15px 0;
-        color: #2d2d2d;
     }
     
-    .result-card h2, .result-card h3 {
-        color: #2d5016 !important;
+    .result-card h2, .result-card h3, .feature-card h3 {
+        color: var(--leaf-dark) !important;
     }
     
     .result-card p, .result-card strong {
-        color: #333333 !important;
-    }
-    
-    .chat-message {
-        padding: 15px;
-        border-radius: 10px;
-        margin: 10px 0;
-        color: #2d2d2d;
-    }
-    
-    .chat-message strong {
-        color: #1a1a1a !important;
-    }
-    
-    .user-message {
-        background: #e3f2fd;
-        margin-left: 20%;
-        color: #1565c0;
-    }
-    
-    .user-message strong {
-        color: #0d47a1 !important;
-    }
-    
-    .bot-message {
-        background: #f5f5f5;
-        margin-right: 20%;
-        color: #2d2d2d;
-    }
-    
-    .bot-message strong {
-        color: #1a1a1a !important;
+        color: var(--text) !important;
     }
     
     .feature-card {
-        background: white;
         padding: 20px;
         border-radius: 12px;
         box-shadow: 0 2px 8px rgba(0,0,0,0.05);
         text-align: center;
         transition: transform 0.3s;
-        color: #333333;
-    }
-    
-    .feature-card h3 {
-        color: #2d5016 !important;
     }
     
     .feature-card p {
-        color: #555555 !important;
+        color: var(--text-muted) !important;
     }
     
     .feature-card:hover {
         transform: translateY(-5px);
     }
-    
-    .stat-box {
-        background: white;
-        padding: 20px;
-        border-radius: 12px;
-        text-align: center;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-        color: #333333;
-    }
-    
-    .stat-box div:not(.stat-number) {
-        color: #555555 !important;
-    }
-    
-    .stat-number {
-        font-size: 36px;
-        font-weight: bold;
-        color: #56ab2f;
-    }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+@st.cache_resource
+def minified_css():
+    """
+    CSS with indentation and line breaks collapsed - computed once per process
+    """
+    return re.sub(r"\s*([{}:;,>])\s*", r"\1", re.sub(r"\s+", " ", CSS)).strip()
+
+
+# Streamlit only keeps elements emitted during the current run, so this has
+# to be re-sent on every rerun - send the minified copy, built once
+st.markdown(minified_css(), unsafe_allow_html=True)
 
 # ----------------------------------
 # Initialize Session State
 # ----------------------------------
+CHAT_HISTORY_LIMIT = 200  # messages kept on screen - the AI only sees the last CHAT_WINDOW plus the periodic summary
+DETECTION_HISTORY_LIMIT = 50  # records kept on My Plants
+
 if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+    st.session_state.chat_history = deque(maxlen=CHAT_HISTORY_LIMIT)
+if 'chat_summary' not in st.session_state:
+    st.session_state.chat_summary = None
+if 'chat_turns' not in st.session_state:
+    st.session_state.chat_turns = 0
 if 'plant_context' not in st.session_state:
     st.session_state.plant_context = None
+if 'system_prompt' not in st.session_state:
+    st.session_state.system_prompt = None  # built once per plant context
 if 'detection_history' not in st.session_state:
-    st.session_state.detection_history = []
+    st.session_state.detection_history = deque(maxlen=DETECTION_HISTORY_LIMIT)
+
+PREVIEW_SIZE = (600, 600)  # uploaded image preview on Plant Detection
 
 # ----------------------------------
 # API Configuration - Multiple FREE Options!
@@ -168,169 +158,216 @@ TOGETHER_API_KEY = st.secrets.get("TOGETHER_API_KEY", "")  # FREE credits
 MISTRAL_API_KEY = st.secrets.get("MISTRAL_API_KEY", "")  # FREE tier available
 
 # ----------------------------------
-# Plant Detection with Groq (FREE Vision AI!)
+# Background Workers
 # ----------------------------------
-def detect_plant_with_groq_llama_vision(image_data):
+@st.cache_resource
+def get_executor():
     """
-    Detect plant using Groq's Llama 3.2 Vision (100% FREE!)
-    Note: Groq vision is still in preview and may have limitations
+    Shared thread pool for network calls that can run in the background
+    (kept across reruns so worker threads are reused)
     """
-    if not GROQ_API_KEY:
-        return {
-            "error": True,
-            "message": "Groq API key not configured"
-        }
-    
-    try:
-        # Resize image to reduce size (Groq has size limits)
-        max_size = (800, 800)
-        image_copy = image_data.copy()
-        image_copy.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Convert to base64
-        buffered = io.BytesIO()
-        image_copy.save(buffered, format="JPEG", quality=85)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
-        
-        # Groq API endpoint
-        API_URL = "https://api.groq.com/openai/v1/chat/completions"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {GROQ_API_KEY}"
-        }
-        
-        # Simplified prompt that works better with vision models
-        payload = {
-            "model": "llama-3.2-11b-vision-preview",  # Using 11B model (more stable)
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Look at this plant image. Identify it and provide:
-- Common name
-- Scientific name (Genus species)
-- Plant family
-- Brief description (2-3 sentences)
-- 3 care tips
-- Is it edible?
-- Native region
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="plant-doctor")
+
+
+@st.cache_resource
+def get_http_session():
+    """
+    One pooled HTTP session for every API call (keep-alive, so only the
+    first request to each provider pays the TCP + TLS handshake)
+    """
+    # Only retry failed connects - nothing reached the provider, so nothing was billed.
+    # Status errors (429/5xx) come straight back to the app's own fallback,
+    # hedging and provider cooldown instead of re-sending the generation here
+    retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def warm_up_connection(api_url, api_key):
+    """
+    Open a pooled TLS connection to an OpenAI-style API in the background
+    (a free GET of its model list), so the next real call skips the handshake
+    """
+    models_url = api_url.removesuffix("/chat/completions") + "/models"
+    get_executor().submit(
+        get_http_session().get, models_url,
+        headers={"Authorization": f"Bearer {api_key}"}, timeout=10
+    )
+
+
+@st.cache_resource
+def get_inflight_detections():
+    """
+    Detection requests currently running, shared by every session:
+    (lock, {provider:settings_key:images_key -> Future})
+    """
+    return threading.Lock(), {}
+
+
+@st.cache_resource
+def get_last_good_providers():
+    """
+    Provider that answered last, per kind ("vision", "chat"), shared by every
+    session - the API keys are app-wide, so a cold or failing provider is too
+    """
+    return {}
+
+
+def last_good_first(kind, providers):
+    """
+    providers (tuples starting with the provider name) in their usual order,
+    except that the last one that answered moves to the front
+    """
+    winner = get_last_good_providers().get(kind)
+    return sorted(providers, key=lambda provider: provider[0] != winner)  # stable sort
+
+
+@st.cache_resource
+def get_provider_cooldowns():
+    """
+    {provider: time.monotonic() until which it is skipped}, shared by every session
+    """
+    return {}
+
+
+def cool_down(provider, status):
+    """
+    Circuit breaker - bench a provider after a response that will likely repeat:
+    a bad key for a minute, rate limits and server errors for a few seconds
+    """
+    if status in (401, 403):
+        get_provider_cooldowns()[provider] = time.monotonic() + 60
+    elif status == 429 or status >= 500:
+        get_provider_cooldowns()[provider] = time.monotonic() + 15
 
-Format as JSON."""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{img_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 1000,
-            "temperature": 0.2
-        }
-        
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            
-            if "choices" in result and len(result["choices"]) > 0:
-                text_content = result["choices"][0]["message"]["content"]
-                
-                try:
-                    import re
-                    # Clean up response
-                    text_content = re.sub(r'```json\s*|\s*```', '', text_content).strip()
-                    json_match = re.search(r'\{[\s\S]*\}', text_content)
-                    
-                    if json_match:
-                        plant_data = json.loads(json_match.group())
-                        # Ensure we have required fields
-                        if "plant_name" not in plant_data:
-                            plant_data["plant_name"] = "Detected Plant"
-                        if "confidence" not in plant_data:
-                            plant_data["confidence"] = 85
-                    else:
-                        # Extract info from text response
-                        plant_data = {
-                            "plant_name": "Detected Plant",
-                            "description": text_content[:500],
-                            "confidence": 80
-                        }
-                    
-                    return {
-                        "error": False,
-                        "data": plant_data,
-                        "raw_response": text_content,
-                        "source": "Groq Llama 11B Vision"
-                    }
-                except json.JSONDecodeError:
-                    return {
-                        "error": False,
-                        "data": {
-                            "plant_name": "Detected Plant",
-                            "description": text_content[:500],
-                            "confidence": 75
-                        },
-                        "raw_response": text_content,
-                        "source": "Groq Llama Vision"
-                    }
-            else:
-                return {"error": True, "message": "No content in response"}
-        else:
-            error_detail = ""
-            try:
-                error_data = response.json()
-                error_detail = f" - {error_data.get('error', {}).get('message', '')}"
-            except:
-                pass
-            return {"error": True, "message": f"API Error: {response.status_code}{error_detail}"}
-            
-    except Exception as e:
-        return {"error": True, "message": f"Error: {str(e)}"}
 
+def is_cooling_down(provider):
+    """True while a provider is benched by cool_down"""
+    return get_provider_cooldowns().get(provider, 0) > time.monotonic()
 
 # ----------------------------------
-# Plant Detection with Pixtral (Mistral Vision - FREE!)
+# Image Encoding
 # ----------------------------------
-def detect_plant_with_mistral_vision(image_data):
+@st.cache_data(max_entries=16, show_spinner=False)
+def encode_image_b64(image_bytes, mime, max_size=(1024, 1024), quality=85):
     """
-    Detect plant using Mistral's Pixtral vision model (FREE!)
-    Very reliable and works great in Egypt
+    Downscale and recompress an uploaded image, then base64 it for a data: URL
+    JPEGs already within max_size are sent as-is (no decode/re-encode round-trip)
+    Cached per (bytes, size, quality) so retries and provider fallbacks reuse the encode
     """
-    if not MISTRAL_API_KEY:
-        return {"error": True, "message": "Mistral API key not configured"}
-    
+    image = Image.open(io.BytesIO(image_bytes))  # lazy - only the header is read here
+
+    if mime == "image/jpeg" and image.width <= max_size[0] and image.height <= max_size[1]:
+        return base64.b64encode(image_bytes).decode()
+
+    # Vision models downscale internally anyway, so extra pixels only cost upload time
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        # Flatten onto white - a plain RGB convert turns transparent areas black
+        image = Image.alpha_composite(Image.new("RGBA", image.size, "white"), image.convert("RGBA"))
+    if image.mode != "RGB":
+        image = image.convert("RGB")  # JPEG can't store alpha or palette PNGs
+
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+# ----------------------------------
+# Response Parsing
+# ----------------------------------
+PLANT_FIELDS = (
+    "plant_name", "scientific_name", "family", "confidence", "description",
+    "care_tips", "interesting_facts", "common_issues", "is_edible", "native_region"
+)
+
+def first_json_object(text):
+    """
+    First balanced {...} in text that parses as JSON, skipping braces inside
+    strings - quotes are only tracked inside a candidate, so prose like 12" pot is fine
+    Returns None if there isn't one
+    """
+    start = text.find("{")
+    while start != -1:
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            char = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    try:
+                        return json.loads(text[start:i + 1])
+                    except json.JSONDecodeError:
+                        break  # not JSON (e.g. {name} in prose) - try the next {
+        start = text.find("{", start + 1)
+    return None
+
+
+def extract_json(text_content):
+    """
+    Parse the JSON a model put in its reply
+    Returns None if the reply doesn't contain any
+    """
+    # JSON-mode replies (Mistral, Groq) parse on the first try; the fence and
+    # scanner fallbacks are for providers without it (Together)
+    text = text_content.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+
     try:
-        # Resize image
-        max_size = (1024, 1024)
-        image_copy = image_data.copy()
-        image_copy.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        buffered = io.BytesIO()
-        image_copy.save(buffered, format="JPEG", quality=90)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
-        
-        API_URL = "https://api.mistral.ai/v1/chat/completions"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {MISTRAL_API_KEY}"
-        }
-        
-        payload = {
-            "model": "pixtral-12b-2409",  # FREE vision model
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Identify this plant. Provide in JSON format:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        # Reply has prose (or several objects) around the JSON - take the first object
+        return first_json_object(text)
+
+
+def parse_plants_reply(text_content):
+    """
+    List of plant dicts from a model reply - one per image for batch replies
+    ({"plants": [...]}), a single entry otherwise
+    """
+    data = extract_json(text_content)
+    if isinstance(data, dict) and isinstance(data.get("plants"), list):
+        items = [item for item in data["plants"] if isinstance(item, dict)]
+    elif isinstance(data, dict):
+        items = [data]
+    else:
+        items = []
+
+    if not items:
+        # Extract info from text response
+        return [{
+            "plant_name": "Detected Plant",
+            "description": text_content[:500],
+            "confidence": 80
+        }]
+
+    plants = []
+    for item in items:
+        # Keep only the keys the UI renders
+        plant_data = {key: item[key] for key in PLANT_FIELDS if key in item}
+        plant_data.setdefault("plant_name", "Detected Plant")
+        plant_data.setdefault("confidence", 85)
+        plants.append(plant_data)
+    return plants
+
+
+# Identification prompts - built once per script run and shared by every provider call
+IDENTIFY_PROMPT = """Identify this plant. Provide in JSON format:
 {
     "plant_name": "common name",
     "scientific_name": "Genus species",
@@ -343,192 +380,305 @@ def detect_plant_with_mistral_vision(image_data):
     "is_edible": true/false,
     "native_region": "region"
 }"""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": f"data:image/jpeg;base64,{img_base64}"
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 1000,
-            "temperature": 0.3
-        }
-        
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            if "choices" in result:
-                text_content = result["choices"][0]["message"]["content"]
-                
-                try:
-                    import re
-                    text_content = re.sub(r'```json\s*|\s*```', '', text_content).strip()
-                    json_match = re.search(r'\{[\s\S]*\}', text_content)
-                    
-                    if json_match:
-                        plant_data = json.loads(json_match.group())
-                        if "plant_name" not in plant_data:
-                            plant_data["plant_name"] = "Detected Plant"
-                        if "confidence" not in plant_data:
-                            plant_data["confidence"] = 85
-                        
-                        return {
-                            "error": False,
-                            "data": plant_data,
-                            "source": "Mistral Pixtral Vision"
-                        }
-                except:
-                    pass
-                
-                return {
-                    "error": False,
-                    "data": {
-                        "plant_name": "Detected Plant",
-                        "description": text_content[:500],
-                        "confidence": 80
-                    },
-                    "source": "Mistral Pixtral"
-                }
-        
-        return {"error": True, "message": f"API Error: {response.status_code}"}
-    except Exception as e:
-        return {"error": True, "message": f"Error: {str(e)}"}
+
+# Simplified prompt that works better with Groq's smaller vision model
+GROQ_IDENTIFY_PROMPT = """Look at this plant image. Identify it and provide:
+- Common name
+- Scientific name (Genus species)
+- Plant family
+- Brief description (2-3 sentences)
+- 3 care tips
+- Is it edible?
+- Native region
+
+Format as JSON."""
+
+BATCH_PROMPT = """Identify the plant in each of these {count} images, in the order given. Provide in JSON format:
+{{
+    "plants": [
+        {{
+            "plant_name": "common name",
+            "scientific_name": "Genus species",
+            "family": "family name",
+            "confidence": 90,
+            "description": "brief description",
+            "care_tips": ["tip1", "tip2", "tip3"],
+            "interesting_facts": "fact",
+            "common_issues": ["issue1", "issue2"],
+            "is_edible": true/false,
+            "native_region": "region"
+        }}
+    ]
+}}
+Return exactly one entry per image."""
+
+
+def identify_prompt(count, single_prompt=IDENTIFY_PROMPT):
+    """
+    Prompt for a request carrying count images
+    """
+    return single_prompt if count == 1 else BATCH_PROMPT.format(count=count)
 
 
 # ----------------------------------
-# Plant Detection with Together AI (FREE credits!)
+# Plant Detection with Vision Models (all FREE!)
 # ----------------------------------
-def detect_plant_with_together(image_data):
+VISION_PROVIDERS = {
+    # Entries are listed in preference order - VISION_ORDER is built from this table
+    "mistral": {
+        "label": "Mistral",  # very reliable, works great in Egypt
+        "source": "Mistral Pixtral Vision",
+        "api_key": MISTRAL_API_KEY,
+        "url": "https://api.mistral.ai/v1/chat/completions",
+        "model": "pixtral-12b-2409",  # FREE vision model
+        "prompt": IDENTIFY_PROMPT,
+        "image_url_is_string": True,  # Mistral wants a bare data: URL
+        "json_mode": True,
+        "max_images": 8,  # several images at once, so a batch is a single request
+        "max_tokens": 1000,
+        "temperature": 0.3,
+    },
+    "groq": {
+        "label": "Groq",  # FREE and FAST! (vision is still in preview)
+        "source": "Groq Llama 11B Vision",
+        "api_key": GROQ_API_KEY,
+        "url": "https://api.groq.com/openai/v1/chat/completions",
+        "model": "llama-3.2-11b-vision-preview",  # 11B model (more stable)
+        "prompt": GROQ_IDENTIFY_PROMPT,
+        "image_url_is_string": False,
+        "json_mode": True,
+        "max_images": 1,
+        "max_tokens": 1000,
+        "temperature": 0.2,
+    },
+    "together": {
+        "label": "Together AI",  # FREE $25 credits
+        "source": "Together AI",
+        "api_key": TOGETHER_API_KEY,
+        "url": "https://api.together.xyz/v1/chat/completions",
+        "model": "meta-llama/Llama-3.2-90B-Vision-Instruct-Turbo",
+        "prompt": IDENTIFY_PROMPT,
+        "image_url_is_string": False,
+        "json_mode": False,  # no JSON mode - extract_json falls back to scanning
+        "max_images": 1,
+        "max_tokens": 1500,
+        "temperature": 0.3,
+    },
+}
+
+
+def detect_plant_with_vision(provider, images):
     """
-    Detect plant using Together AI's vision models (FREE $25 credits!)
+    Identify the plants in images with one request to a VISION_PROVIDERS entry
+    images: list of (image_bytes, mime) - at most the provider's max_images
     """
-    if not TOGETHER_API_KEY:
-        return {"error": True, "message": "Together API key not configured"}
+    config = VISION_PROVIDERS[provider]
+    if not config["api_key"]:
+        return {"error": True, "message": f"{config['label']} API key not configured"}
     
     try:
-        buffered = io.BytesIO()
-        image_data.save(buffered, format="JPEG")
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
+        # Same size and quality for every provider, so a fallback reuses the cached encode
+        encoded = [encode_image_b64(image_bytes, mime) for image_bytes, mime in images]
         
-        API_URL = "https://api.together.xyz/v1/chat/completions"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {TOGETHER_API_KEY}"
-        }
+        image_parts = []
+        for img_base64 in encoded:
+            data_url = f"data:image/jpeg;base64,{img_base64}"
+            image_parts.append({
+                "type": "image_url",
+                "image_url": data_url if config["image_url_is_string"] else {"url": data_url}
+            })
         
         payload = {
-            "model": "meta-llama/Llama-3.2-90B-Vision-Instruct-Turbo",
+            "model": config["model"],
             "messages": [
                 {
                     "role": "user",
                     "content": [
-                        {
-                            "type": "text",
-                            "text": """Identify this plant and provide details in JSON format:
-{
-    "plant_name": "Common name",
-    "scientific_name": "Genus species",
-    "family": "Family",
-    "confidence": 90,
-    "description": "Brief description",
-    "care_tips": ["tip1", "tip2", "tip3"],
-    "interesting_facts": "Fact",
-    "common_issues": ["issue1", "issue2"],
-    "is_edible": true,
-    "native_region": "Region"
-}"""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{img_base64}"
-                            }
-                        }
-                    ]
+                        {"type": "text", "text": identify_prompt(len(encoded), config["prompt"])}
+                    ] + image_parts
                 }
             ],
-            "max_tokens": 1500,
-            "temperature": 0.3
+            "max_tokens": config["max_tokens"],
+            "temperature": config["temperature"]
         }
+        if config["json_mode"]:
+            # JSON mode - the reply is a bare JSON object, no fences or prose
+            payload["response_format"] = {"type": "json_object"}
         
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
+        headers = {"Authorization": f"Bearer {config['api_key']}"}
+        response = get_http_session().post(config["url"], headers=headers, json=payload, timeout=30)
         
-        if response.status_code == 200:
-            result = response.json()
-            if "choices" in result:
-                text_content = result["choices"][0]["message"]["content"]
-                
-                try:
-                    import re
-                    text_content = re.sub(r'```json\s*|\s*```', '', text_content).strip()
-                    json_match = re.search(r'\{[\s\S]*\}', text_content)
-                    
-                    if json_match:
-                        plant_data = json.loads(json_match.group())
-                        return {
-                            "error": False,
-                            "data": plant_data,
-                            "source": "Together AI"
-                        }
-                except:
-                    pass
-                
-                return {
-                    "error": False,
-                    "data": {
-                        "plant_name": "Detected Plant",
-                        "description": text_content[:500],
-                        "confidence": 80
-                    },
-                    "source": "Together AI"
-                }
+        if response.status_code != 200:
+            error_detail = ""
+            try:
+                error_detail = f" - {response.json().get('error', {}).get('message', '')}"
+            except Exception:
+                pass
+            return {"error": True, "status": response.status_code, "message": f"API Error: {response.status_code}{error_detail}"}
+        
+        result = response.json()
+        if not result.get("choices"):
+            return {"error": True, "message": "No content in response"}
         
-        return {"error": True, "message": f"API Error: {response.status_code}"}
+        text_content = result["choices"][0]["message"]["content"]
+        return {
+            "error": False,
+            "plants": parse_plants_reply(text_content),
+            "raw_response": text_content,
+            "source": config["source"]
+        }
     except Exception as e:
         return {"error": True, "message": f"Error: {str(e)}"}
 
 
 # ----------------------------------
-# Smart Plant Detection (tries multiple free APIs)
+# Detection Cache (keyed by image content)
 # ----------------------------------
-def smart_plant_detection(image_data):
+class DetectionError(Exception):
+    """Raised inside the cached call so failed detections are never memoized - carries the error dict"""
+
+
+def image_cache_key(image_bytes):
     """
-    Try multiple FREE APIs in order until one works
+    Stable key for an uploaded image - BLAKE2b of the raw file bytes
     """
-    st.info("🔄 Trying FREE AI models...")
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+def provider_cache_key(provider):
+    """
+    Fingerprint of everything that shapes a provider's reply (model, prompts,
+    sampling settings) - changing any of them stops old cached replies being served
+    """
+    settings = {key: value for key, value in VISION_PROVIDERS[provider].items() if key != "api_key"}
+    settings["batch_prompt"] = BATCH_PROMPT
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+@st.cache_data(ttl=86400, max_entries=256, show_spinner=False)
+def detect_cached(provider, settings_key, images_key, _images):
+    """
+    Run one provider request, memoized per (provider, its settings, image hashes)
+    The image bytes are excluded from hashing - images_key already identifies them
+    """
+    result = detect_once(provider, settings_key, images_key, _images)
+    if result.get("error"):
+        raise DetectionError(result)
+    if len(result["plants"]) != len(_images):
+        # e.g. a single object, or the text fallback, for a batch of several images
+        raise DetectionError({
+            "error": True,
+            "batch_mismatch": True,
+            "message": f"Got {len(result['plants'])} results for {len(_images)} images"
+        })
+    return result
+
+
+def detect_once(provider, settings_key, images_key, images):
+    """
+    Call the provider, or wait on an identical call that is already running
+    (double-clicked Identify, same photo uploaded in two tabs) instead of
+    sending a second request
+    """
+    lock, inflight = get_inflight_detections()
+    key = f"{provider}:{settings_key}:{images_key}"  # same identity as detect_cached
+    with lock:
+        future = inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            inflight[key] = future
     
-    # Try Mistral Pixtral first (very reliable!)
-    if MISTRAL_API_KEY:
-        with st.spinner("🎯 Trying Mistral Pixtral Vision (FREE)..."):
-            result = detect_plant_with_mistral_vision(image_data)
-            if not result.get("error"):
-                st.success(f"✅ Success with {result.get('source', 'Mistral')}!")
-                return result
-            else:
-                st.warning(f"⚠️ Mistral failed: {result.get('message')}")
+    if not leader:
+        return future.result()
     
-    # Try Groq (FREE and FAST!)
-    if GROQ_API_KEY:
-        with st.spinner("🚀 Trying Groq Llama Vision (FREE)..."):
-            result = detect_plant_with_groq_llama_vision(image_data)
-            if not result.get("error"):
-                st.success(f"✅ Success with {result.get('source', 'Groq')}!")
-                return result
-            else:
-                st.warning(f"⚠️ Groq failed: {result.get('message')}")
+    try:
+        result = detect_plant_with_vision(provider, images)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with lock:
+            inflight.pop(key, None)
+
+
+def detect_with(provider, images, image_keys):
+    """
+    Cached detection of all images, in as few requests as the provider allows
+    Returns one plant per image, in upload order
+    Reports failures the same way the detectors do
+    """
+    max_images = VISION_PROVIDERS[provider]["max_images"]
+    settings_key = provider_cache_key(provider)
+    plants = []
+    source = provider
+    batches = [
+        (images[start:start + max_images], image_keys[start:start + max_images])
+        for start in range(0, len(images), max_images)
+    ]
     
-    # Try Together AI (FREE $25 credits)
-    if TOGETHER_API_KEY:
-        with st.spinner("🔄 Trying Together AI (FREE)..."):
-            result = detect_plant_with_together(image_data)
-            if not result.get("error"):
-                st.success(f"✅ Success with {result.get('source', 'Together')}!")
-                return result
-            else:
-                st.warning(f"⚠️ Together AI failed: {result.get('message')}")
+    while batches:
+        batch, keys = batches.pop(0)
+        try:
+            result = detect_cached(provider, settings_key, "+".join(keys), batch)
+        except DetectionError as e:
+            if len(batch) > 1 and e.args[0].get("batch_mismatch"):
+                # Not one entry per image - ask about each of them on its own
+                batches[:0] = [([image], [key]) for image, key in zip(batch, keys)]
+                continue
+            return e.args[0]
+        plants.extend(result["plants"])
+        source = result.get("source", source)
+    
+    return {"error": False, "plants": plants, "source": source}
+
+
+# ----------------------------------
+# Smart Plant Detection (tries multiple free APIs)
+# ----------------------------------
+# (provider, api key, label) in VISION_PROVIDERS order - derived, never edited by hand;
+# smart_plant_detection moves the last good provider to the front
+VISION_ORDER = [(provider, config["api_key"], config["label"]) for provider, config in VISION_PROVIDERS.items()]
+
+HEDGE_AFTER = 8  # seconds a provider gets before the next one is started alongside it
+
+
+def smart_plant_detection(images, image_keys):
+    """
+    Try multiple FREE APIs until one works, starting with the last one that did
+    images: list of (image_bytes, mime); image_keys: matching image_cache_key values
+    Providers are hedged: the next one starts as soon as the current one fails
+    or is still running after HEDGE_AFTER seconds, and the first success wins
+    Repeat uploads of the same images are answered from the cache, and providers
+    that just failed with a bad key, rate limit or server error sit out a cooldown
+    """
+    st.info("🔄 Trying FREE AI models...")
+    providers = [(provider, label) for provider, api_key, label in last_good_first("vision", VISION_ORDER) if api_key]
+    # Skip providers that just failed hard - unless that's all of them
+    providers = [p for p in providers if not is_cooling_down(p[0])] or providers
+    executor = get_executor()
+    pending = {}
+    
+    with st.spinner("🎯 Identifying with FREE vision models..."):
+        for i, (provider, label) in enumerate(providers):
+            pending[executor.submit(detect_with, provider, images, image_keys)] = (provider, label)
+            last = i == len(providers) - 1
+            
+            while pending:
+                done, _ = wait(pending, timeout=None if last else HEDGE_AFTER, return_when=FIRST_COMPLETED)
+                for future in done:
+                    provider, label = pending.pop(future)
+                    result = future.result()
+                    if not result.get("error"):
+                        get_last_good_providers()["vision"] = provider
+                        st.success(f"✅ Success with {result.get('source', label)}!")
+                        return result
+                    cool_down(provider, result.get("status", 0))
+                    st.warning(f"⚠️ {label} failed: {result.get('message')}")
+                if not last:
+                    break  # failed or slow - bring in the next provider
     
     return {
         "error": True,
@@ -539,111 +689,449 @@ def smart_plant_detection(image_data):
 # ----------------------------------
 # Chat Functions (Multiple FREE Options)
 # ----------------------------------
-def chat_with_ai(user_message, context=None):
+CHAT_PROVIDERS = [
+    # (name, api key, endpoint, model) - tried in this order, last good one first
+    ("Groq", GROQ_API_KEY, "https://api.groq.com/openai/v1/chat/completions", "llama-3.1-70b-versatile"),  # fastest
+    ("Mistral", MISTRAL_API_KEY, "https://api.mistral.ai/v1/chat/completions", "mistral-small-latest"),  # FREE tier
+    ("Together AI", TOGETHER_API_KEY, "https://api.together.xyz/v1/chat/completions", "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo"),
+]
+
+CHAT_WINDOW = 6  # most recent messages sent to the model verbatim
+SUMMARY_EVERY = 10  # turns between summaries of the older conversation
+CHAT_MIN_TOKENS = 300  # reply budget for a one-word question
+CHAT_MAX_TOKENS = 800  # ...growing with the question up to this
+
+CHAT_FAILED_MESSAGE = "❌ All chat APIs failed. Please check your API keys are valid. Make sure you have at least one API key (Groq, Mistral, or Together AI) configured in your secrets.toml file."
+
+SYSTEM_PROMPT_TEMPLATE = Template("""You are a helpful plant expert specializing in Egypt and Middle East.
+
+Current plant context:
+- Plant: $plant_name
+- Scientific Name: $scientific_name
+- Family: $family
+
+Provide practical, actionable advice suitable for Egyptian climate. Be concise, friendly, and focus on real-world tips.""")
+
+SYSTEM_PROMPT_NO_CONTEXT = "You are a knowledgeable plant expert with expertise in Egyptian and Middle Eastern plants, climate, and gardening. Provide helpful, practical advice. Be concise and friendly."
+
+
+def reply_token_budget(user_message):
     """
-    Chat using multiple FREE AI APIs with fallback
+    max_tokens for a reply - short questions get short answers, so generation
+    (and the wait) isn't sized for the longest possible one
     """
-    # Build system prompt
-    if context:
-        system_prompt = f"""You are a helpful plant expert specializing in Egypt and Middle East.
+    return min(CHAT_MAX_TOKENS, CHAT_MIN_TOKENS + 25 * len(user_message.split()))
 
-Current plant context:
-- Plant: {context.get('plant_name', 'Unknown')}
-- Scientific Name: {context.get('scientific_name', 'N/A')}
-- Family: {context.get('family', 'N/A')}
 
-Provide practical, actionable advice suitable for Egyptian climate. Be concise, friendly, and focus on real-world tips."""
-    else:
-        system_prompt = "You are a knowledgeable plant expert with expertise in Egyptian and Middle Eastern plants, climate, and gardening. Provide helpful, practical advice. Be concise and friendly."
-    
-    # Try Groq first (fastest)
-    if GROQ_API_KEY:
+def chat_completion(messages, max_tokens=CHAT_MAX_TOKENS, temperature=0.7):
+    """
+    Send a message list to the first FREE chat API that answers
+    Returns None if every configured API failed
+    """
+    for name, api_key, api_url, model in last_good_first("chat", CHAT_PROVIDERS):
+        if not api_key:
+            continue
+        
         try:
-            API_URL = "https://api.groq.com/openai/v1/chat/completions"
-            
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {GROQ_API_KEY}"
-            }
+            headers = {"Authorization": f"Bearer {api_key}"}
             
             payload = {
-                "model": "llama-3.1-70b-versatile",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                "max_tokens": 800,
-                "temperature": 0.7
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature
             }
             
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
+            response = get_http_session().post(api_url, headers=headers, json=payload, timeout=30)
             
             if response.status_code == 200:
                 result = response.json()
                 if "choices" in result and len(result["choices"]) > 0:
+                    get_last_good_providers()["chat"] = name
                     return result["choices"][0]["message"]["content"]
-        except Exception as e:
+        except Exception:
             pass  # Fall through to next API
     
-    # Try Mistral as backup
-    if MISTRAL_API_KEY:
+    return None
+
+
+def stream_chat_completion(messages, max_tokens=CHAT_MAX_TOKENS, temperature=0.7):
+    """
+    Like chat_completion, but yields the reply token-by-token as it's generated (SSE)
+    Falls through to the next API only if one fails before producing any text
+    """
+    for name, api_key, api_url, model in last_good_first("chat", CHAT_PROVIDERS):
+        if not api_key:
+            continue
+        
+        started = False
         try:
-            API_URL = "https://api.mistral.ai/v1/chat/completions"
-            
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {MISTRAL_API_KEY}"
-            }
+            headers = {"Authorization": f"Bearer {api_key}"}
             
             payload = {
-                "model": "mistral-small-latest",  # FREE tier
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                "max_tokens": 800,
-                "temperature": 0.7
+                "model": model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stream": True
             }
             
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-            
-            if response.status_code == 200:
-                result = response.json()
-                if "choices" in result and len(result["choices"]) > 0:
-                    return result["choices"][0]["message"]["content"]
-        except Exception as e:
-            pass  # Fall through to next API
+            with get_http_session().post(api_url, headers=headers, json=payload, timeout=30, stream=True) as response:
+                if response.status_code != 200:
+                    continue  # Fall through to next API
+                
+                for line in response.iter_lines():
+                    # SSE frames look like `data: {...}`, ending with `data: [DONE]`
+                    if not line.startswith(b"data: "):
+                        continue
+                    data = line[len(b"data: "):]
+                    if data == b"[DONE]":
+                        break
+                    
+                    choices = json.loads(data).get("choices")
+                    if choices:
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            if not started:
+                                started = True
+                                get_last_good_providers()["chat"] = name
+                            yield delta
+            if started:
+                return
+            # 200 but no text (empty deltas or an immediate [DONE]) - try the next API
+        except Exception:
+            if started:
+                return  # Part of the answer is already on screen - don't restart with another API
     
-    # Try Together AI as last resort
-    if TOGETHER_API_KEY:
-        try:
-            API_URL = "https://api.together.xyz/v1/chat/completions"
-            
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {TOGETHER_API_KEY}"
-            }
-            
-            payload = {
-                "model": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                "max_tokens": 800,
-                "temperature": 0.7
-            }
-            
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-            
-            if response.status_code == 200:
-                result = response.json()
-                if "choices" in result and len(result["choices"]) > 0:
-                    return result["choices"][0]["message"]["content"]
-        except Exception as e:
-            pass
+    yield CHAT_FAILED_MESSAGE
+
+
+def build_system_prompt(context=None):
+    """
+    System prompt for the plant expert, with the identified plant when available
+    """
+    if not context:
+        return SYSTEM_PROMPT_NO_CONTEXT
+    return SYSTEM_PROMPT_TEMPLATE.substitute(
+        plant_name=context.get('plant_name', 'Unknown'),
+        scientific_name=context.get('scientific_name', 'N/A'),
+        family=context.get('family', 'N/A')
+    )
+
+
+def build_chat_messages(user_message, system_prompt=None, history=None, summary=None):
+    """
+    Message list for a chat turn
+    Only the last CHAT_WINDOW messages of history are sent; older turns travel as the
+    summary, which refresh_chat_summary updates every SUMMARY_EVERY turns
+    The summary goes after the system prompt so the prompt stays a byte-identical
+    prefix across turns (providers with prompt caching skip re-reading it)
+    """
+    system_prompt = system_prompt or SYSTEM_PROMPT_NO_CONTEXT
+    if summary:
+        system_prompt = "\n\n".join((system_prompt, f"Summary of the earlier conversation: {summary}"))
+    
+    messages = [{"role": "system", "content": system_prompt}]
+    if history:
+        messages.extend(
+            {"role": m["role"], "content": m["content"]} for m in list(history)[-CHAT_WINDOW:]
+        )
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def chat_with_ai_stream(user_message, system_prompt=None, history=None, summary=None):
+    """
+    Chat using multiple FREE AI APIs with fallback - yields text chunks for st.write_stream
+    """
+    yield from stream_chat_completion(
+        build_chat_messages(user_message, system_prompt, history, summary),
+        max_tokens=reply_token_budget(user_message)
+    )
+
+
+def summarize_history(messages, previous_summary=None):
+    """
+    Fold older chat turns into a short running summary (small, low-temperature call)
+    Returns None if no API answered
+    """
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Previous summary: {previous_summary}\n\n{transcript}"
+    
+    return chat_completion([
+        {"role": "system", "content": "Summarize this plant-care conversation in under 80 words. Keep plant names, problems and the advice given."},
+        {"role": "user", "content": transcript}
+    ], max_tokens=150, temperature=0.3)
+
+
+def summarize_in_background(messages, previous_summary, earlier=None):
+    """
+    summarize_history for the executor - waits for an earlier refresh that is
+    still running, so its summary is built on rather than overwritten
+    Returns the previous summary if no API answered
+    """
+    if earlier is not None:
+        previous_summary = earlier.result() or previous_summary
+    return summarize_history(messages, previous_summary) or previous_summary
+
+
+def refresh_chat_summary():
+    """
+    Every SUMMARY_EVERY turns, fold the messages that slid out of the
+    chat window since the last summary into the running summary
+    The summary call runs in the background, so the next message isn't held up;
+    current_chat_summary picks up its result
+    """
+    history = st.session_state.chat_history
+    batch = 2 * SUMMARY_EVERY  # one turn = user + assistant message
+    # Count turns separately - a full (bounded) history stops growing
+    st.session_state.chat_turns += 1
+    if len(history) <= CHAT_WINDOW or st.session_state.chat_turns % SUMMARY_EVERY != 0:
+        return
     
-    return "❌ All chat APIs failed. Please check your API keys are valid. Make sure you have at least one API key (Groq, Mistral, or Together AI) configured in your secrets.toml file."
+    older = list(history)[-(CHAT_WINDOW + batch):-CHAT_WINDOW]
+    st.session_state.pending_summary = get_executor().submit(
+        summarize_in_background, older, current_chat_summary(), st.session_state.get('pending_summary')
+    )
+
+
+def current_chat_summary():
+    """
+    st.session_state.chat_summary, updated first if a background refresh has finished
+    """
+    pending = st.session_state.get('pending_summary')
+    if pending is not None and pending.done():
+        st.session_state.chat_summary = pending.result()
+        del st.session_state['pending_summary']
+    return st.session_state.chat_summary
+
+
+class ChatError(Exception):
+    """Raised inside cached chat calls so failed replies are never memoized"""
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_quick_answer(question, context=None):
+    """
+    Reply to a quick question - there's no history, so the same question about
+    the same plant is asked once and shared by every session
+    """
+    reply = chat_completion(
+        build_chat_messages(question, build_system_prompt(context)),
+        max_tokens=reply_token_budget(question)
+    )
+    if reply is None:
+        raise ChatError(question)
+    return reply
+
+
+def quick_answer(question, context=None):
+    """
+    Cached quick-question reply, or the usual failure message
+    """
+    try:
+        return cached_quick_answer(question, context)
+    except ChatError:
+        return CHAT_FAILED_MESSAGE
+
+
+def quick_answer_future(question):
+    """
+    Background call answering a quick question about the current plant context
+    Reuses the one already submitted unless it failed, so a click after a
+    failure asks again instead of replaying the error
+    """
+    prefetch = st.session_state.quick_answers
+    future = prefetch['answers'].get(question)
+    if future is None or (future.done() and future.result() == CHAT_FAILED_MESSAGE):
+        future = get_executor().submit(quick_answer, question, prefetch['context'])
+        prefetch['answers'][question] = future
+    return future
+
+
+def warm_up_chat_connection():
+    """
+    Warm the connection to the chat API the next message will go to
+    """
+    for name, api_key, api_url, model in last_good_first("chat", CHAT_PROVIDERS):
+        if api_key:
+            warm_up_connection(api_url, api_key)
+            return
+
+
+# ----------------------------------
+# Result Display
+# ----------------------------------
+# Card markup; values are HTML-escaped since they come from the model
+RESULT_CARD = Template("""
+<div class="result-card">
+    <h2>🌿 $plant_name</h2>
+    <p><strong>Image:</strong> $image_name</p>
+    <p><strong>Scientific Name:</strong> $scientific_name</p>
+    <p><strong>Family:</strong> $family</p>
+    <p><strong>Confidence:</strong> $confidence%</p>
+    <p><strong>Source:</strong> $source</p>
+    <hr>
+    <p><strong>Description:</strong><br>$description</p>
+</div>
+""")
+
+FACTS_CARD = Template("""
+<div class="result-card">
+    <h3>✨ Did You Know?</h3>
+    <p>$facts</p>
+</div>
+""")
+
+
+def render_plant_result(data, source, image_name):
+    """
+    Result card, care tips and extra info for one identified plant
+    """
+    st.markdown(RESULT_CARD.substitute(
+        plant_name=html.escape(str(data.get("plant_name", "Unknown Plant"))),
+        image_name=html.escape(image_name),
+        scientific_name=html.escape(str(data.get("scientific_name", "N/A"))),
+        family=html.escape(str(data.get("family", "N/A"))),
+        confidence=html.escape(str(data.get("confidence", 0))),
+        source=html.escape(str(source)),
+        description=html.escape(str(data.get("description", "No description available")))
+    ), unsafe_allow_html=True)
+    
+    # Care Tips
+    if "care_tips" in data and data["care_tips"]:
+        st.markdown("### 💧 Care Tips")
+        for tip in data["care_tips"]:
+            st.write(f"• {tip}")
+    
+    # Additional Info
+    col_a, col_b = st.columns(2)
+    
+    with col_a:
+        if "is_edible" in data:
+            edible_status = "✅ Edible" if data["is_edible"] else "⚠️ Not Edible"
+            st.info(edible_status)
+    
+    with col_b:
+        if "native_region" in data:
+            st.info(f"🌍 {data['native_region']}")
+    
+    # Interesting Facts
+    if "interesting_facts" in data:
+        st.markdown(FACTS_CARD.substitute(facts=html.escape(str(data['interesting_facts']))), unsafe_allow_html=True)
+    
+    # Common Issues
+    if "common_issues" in data and data["common_issues"]:
+        with st.expander("⚠️ Common Issues"):
+            for issue in data["common_issues"]:
+                st.write(f"• {issue}")
+
+
+# ----------------------------------
+# Chat Panel
+# ----------------------------------
+def ask_quick_question(question):
+    """
+    Quick-question button callback - adds the question and its prefetched answer
+    Runs before the rerun the click triggers, so no extra st.rerun() is needed
+    An answer still in flight is left for chat_panel to wait on under a spinner
+    """
+    st.session_state.chat_history.append({'role': 'user', 'content': question})
+    answer = quick_answer_future(question)
+    if answer.done():
+        st.session_state.chat_history.append({'role': 'assistant', 'content': answer.result()})
+        refresh_chat_summary()
+    else:
+        st.session_state.pending_quick_answer = answer
+
+
+def clear_chat():
+    """Clear Chat button callback"""
+    st.session_state.chat_history.clear()
+    st.session_state.pop('pending_quick_answer', None)
+    st.session_state.pop('pending_summary', None)
+    st.session_state.chat_summary = None
+    st.session_state.chat_turns = 0
+
+
+def clear_detection_history():
+    """Clear History button callback"""
+    st.session_state.detection_history.clear()
+
+
+@st.fragment
+def chat_panel():
+    """
+    Chat history, input and quick questions
+    A fragment, so sending a message reruns only this panel - not the sidebar,
+    CSS and the rest of the page
+    """
+    # Chat History
+    if len(st.session_state.chat_history) == CHAT_HISTORY_LIMIT:
+        st.caption(
+            f"Showing the last {CHAT_HISTORY_LIMIT} messages - the AI sees the latest {CHAT_WINDOW} "
+            f"and a summary of earlier ones, updated every {SUMMARY_EVERY} turns."
+        )
+    for message in st.session_state.chat_history:
+        with st.chat_message(message['role']):
+            st.markdown(message['content'])
+    
+    # Quick-question answer that was still being prefetched when it was clicked
+    # (only dropped once it's in the history, so an interrupted run waits again)
+    pending = st.session_state.get('pending_quick_answer')
+    if pending is not None:
+        with st.chat_message('assistant'):
+            with st.spinner("🤔 Thinking..."):
+                response = pending.result()
+            st.markdown(response)
+        st.session_state.chat_history.append({'role': 'assistant', 'content': response})
+        del st.session_state['pending_quick_answer']
+        refresh_chat_summary()
+    
+    # Chat Input (pinned to the bottom; only reruns the script on submit, not per keystroke)
+    user_input = st.chat_input("Ask anything... e.g. How to grow tomatoes in Egypt?")
+    
+    if user_input:
+        history = list(st.session_state.chat_history)
+        st.session_state.chat_history.append({'role': 'user', 'content': user_input})
+        with st.chat_message('user'):
+            st.markdown(user_input)
+        
+        # Render tokens as they arrive instead of waiting for the full reply
+        with st.chat_message('assistant'):
+            response = st.write_stream(
+                chat_with_ai_stream(user_input, st.session_state.system_prompt, history, current_chat_summary())
+            )
+        
+        st.session_state.chat_history.append({'role': 'assistant', 'content': response})
+        refresh_chat_summary()
+    
+    # Quick Questions
+    if len(st.session_state.chat_history) == 0:
+        st.markdown("### 💡 Quick Questions")
+        questions = [
+            "Best plants for Egyptian summer?",
+            "How to deal with aphids?",
+            "Indoor plants for apartments?",
+            "When to fertilize roses?"
+        ]
+
+        # Pre-warm only the first answer (again if the plant context changed) -
+        # the others are asked on click, so opening the page costs one call
+        prefetch = st.session_state.get('quick_answers')
+        if prefetch is None or prefetch['context'] != st.session_state.plant_context:
+            st.session_state.quick_answers = {'context': st.session_state.plant_context, 'answers': {}}
+            quick_answer_future(questions[0])
+
+        cols = st.columns(2)
+        for i, q in enumerate(questions):
+            with cols[i % 2]:
+                st.button(q, key=f"q_{i}", on_click=ask_quick_question, args=(q,))
+    
+    # Clear Chat
+    if len(st.session_state.chat_history) > 0:
+        st.button("🗑️ Clear Chat", on_click=clear_chat)
 
 
 # ----------------------------------
@@ -745,100 +1233,76 @@ elif app_mode == "🔍 Plant Detection":
         """)
         st.stop()
     
+    # Once per session, while the user picks photos - hedging may use any provider
+    if 'vision_warmed' not in st.session_state:
+        st.session_state.vision_warmed = True
+        for provider, api_key, label in VISION_ORDER:
+            if api_key:
+                warm_up_connection(VISION_PROVIDERS[provider]["url"], api_key)
+    
     col1, col2 = st.columns([1, 1])
     
     with col1:
-        st.markdown("### 📸 Upload Plant Image")
-        uploaded_file = st.file_uploader("Upload Plant Image", type=["jpg", "jpeg", "png"], key="plant_upload", label_visibility="collapsed")
+        st.markdown("### 📸 Upload Plant Images")
+        uploaded_files = st.file_uploader("Upload Plant Images", type=["jpg", "jpeg", "png"], key="plant_upload", label_visibility="collapsed", accept_multiple_files=True)
         
-        if uploaded_file:
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Uploaded Image", use_column_width=True)
+        if uploaded_files:
+            # Send the uploaded bytes as-is; PIL only decodes for the preview
+            images = [(f.getvalue(), f.type) for f in uploaded_files]
+            image_keys = [image_cache_key(image_bytes) for image_bytes, mime in images]
             
-            identify_btn = st.button("🔍 Identify Plant", use_container_width=True)
+            # Only small previews go to the browser (st.image re-sends them on every rerun)
+            previews = []
+            for f in uploaded_files:
+                preview = Image.open(f)
+                preview.thumbnail(PREVIEW_SIZE, Image.Resampling.LANCZOS)
+                previews.append(preview)
+            preview_width = PREVIEW_SIZE[0] if len(previews) == 1 else PREVIEW_SIZE[0] // 3
+            st.image(previews, caption=[f.name for f in uploaded_files], width=preview_width)
+            
+            identify_label = "🔍 Identify Plant" if len(images) == 1 else f"🔍 Identify {len(images)} Plants"
+            identify_btn = st.button(identify_label, use_container_width=True)
     
     with col2:
         st.markdown("### 📋 Identification Results")
         
-        if uploaded_file and identify_btn:
-            result = smart_plant_detection(image)
+        if uploaded_files and identify_btn:
+            # All images go out together - one request for providers that accept several
+            result = smart_plant_detection(images, image_keys)
             
             if not result.get("error"):
-                data = result.get("data", {})
-                
-                plant_name = data.get("plant_name", "Unknown Plant")
-                scientific_name = data.get("scientific_name", "N/A")
-                family = data.get("family", "N/A")
-                confidence = data.get("confidence", 0)
-                description = data.get("description", "No description available")
-                
-                st.markdown(f"""
-                <div class="result-card">
-                    <h2>🌿 {plant_name}</h2>
-                    <p><strong>Scientific Name:</strong> {scientific_name}</p>
-                    <p><strong>Family:</strong> {family}</p>
-                    <p><strong>Confidence:</strong> {confidence}%</p>
-                    <p><strong>Source:</strong> {result.get('source', 'AI Model')}</p>
-                    <hr>
-                    <p><strong>Description:</strong><br>{description}</p>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # Care Tips
-                if "care_tips" in data and data["care_tips"]:
-                    st.markdown("### 💧 Care Tips")
-                    for tip in data["care_tips"]:
-                        st.write(f"• {tip}")
-                
-                # Additional Info
-                col_a, col_b = st.columns(2)
+                plants = result["plants"]
                 
-                with col_a:
-                    if "is_edible" in data:
-                        edible_status = "✅ Edible" if data["is_edible"] else "⚠️ Not Edible"
-                        st.info(edible_status)
-                
-                with col_b:
-                    if "native_region" in data:
-                        st.info(f"🌍 {data['native_region']}")
-                
-                # Interesting Facts
-                if "interesting_facts" in data:
-                    st.markdown(f"""
-                    <div class="result-card">
-                        <h3>✨ Did You Know?</h3>
-                        <p>{data['interesting_facts']}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
-                
-                # Common Issues
-                if "common_issues" in data and data["common_issues"]:
-                    with st.expander("⚠️ Common Issues"):
-                        for issue in data["common_issues"]:
-                            st.write(f"• {issue}")
+                # detect_with returns one plant per image, in upload order
+                for i, (data, f) in enumerate(zip(plants, uploaded_files)):
+                    if i > 0:
+                        st.markdown("---")
+                    render_plant_result(data, result.get('source', 'AI Model'), f.name)
+                    
+                    # Save to history
+                    st.session_state.detection_history.append({
+                        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
+                        'plant_name': data.get("plant_name", "Unknown Plant"),
+                        'scientific_name': data.get("scientific_name", "N/A"),
+                        'type': 'identification'
+                    })
                 
-                # Save to context
+                # Save to context (chat follows the first plant)
+                first = plants[0]
                 st.session_state.plant_context = {
-                    'plant_name': plant_name,
-                    'scientific_name': scientific_name,
-                    'family': family,
-                    'confidence': confidence
+                    'plant_name': first.get("plant_name", "Unknown Plant"),
+                    'scientific_name': first.get("scientific_name", "N/A"),
+                    'family': first.get("family", "N/A"),
+                    'confidence': first.get("confidence", 0)
                 }
-                
-                # Save to history
-                st.session_state.detection_history.append({
-                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    'plant_name': plant_name,
-                    'scientific_name': scientific_name,
-                    'type': 'identification'
-                })
+                st.session_state.system_prompt = build_system_prompt(st.session_state.plant_context)
                 
                 st.success("✅ Plant identified! Go to AI Chat for more advice.")
             else:
                 st.error(f"❌ {result.get('message')}")
         
-        elif not uploaded_file:
-            st.info("👆 Upload an image to get started")
+        elif not uploaded_files:
+            st.info("👆 Upload one or more images to get started")
 
 # ----------------------------------
 # AI Chat Page
@@ -856,6 +1320,11 @@ elif app_mode == "💬 AI Chat":
         """)
         st.stop()
     
+    # Once per session, while the user reads the page and types
+    if 'chat_warmed' not in st.session_state:
+        st.session_state.chat_warmed = True
+        warm_up_chat_connection()
+    
     # Display context
     if st.session_state.plant_context:
         with st.expander("📌 Current Plant", expanded=True):
@@ -870,65 +1339,7 @@ elif app_mode == "💬 AI Chat":
     
     st.markdown("---")
     
-    # Chat History
-    for message in st.session_state.chat_history:
-        if message['role'] == 'user':
-            st.markdown(f"""
-            <div class="chat-message user-message">
-                <strong>You:</strong> {message['content']}
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="chat-message bot-message">
-                <strong>🤖 AI:</strong> {message['content']}
-            </div>
-            """, unsafe_allow_html=True)
-    
-    # Chat Input
-    st.markdown("---")
-    col1, col2 = st.columns([5, 1])
-    
-    with col1:
-        user_input = st.text_input("Ask anything...", key="chat_input", placeholder="How to grow tomatoes in Egypt?")
-    
-    with col2:
-        send_btn = st.button("Send 📨", use_container_width=True)
-    
-    if send_btn and user_input:
-        st.session_state.chat_history.append({'role': 'user', 'content': user_input})
-        
-        with st.spinner("🤔 AI thinking..."):
-            response = chat_with_ai(user_input, st.session_state.plant_context)
-        
-        st.session_state.chat_history.append({'role': 'assistant', 'content': response})
-        st.rerun()
-    
-    # Quick Questions
-    if len(st.session_state.chat_history) == 0:
-        st.markdown("### 💡 Quick Questions")
-        questions = [
-            "Best plants for Egyptian summer?",
-            "How to deal with aphids?",
-            "Indoor plants for apartments?",
-            "When to fertilize roses?"
-        ]
-        
-        cols = st.columns(2)
-        for i, q in enumerate(questions):
-            with cols[i % 2]:
-                if st.button(q, key=f"q_{i}"):
-                    st.session_state.chat_history.append({'role': 'user', 'content': q})
-                    with st.spinner("🤔 Thinking..."):
-                        response = chat_with_ai(q, st.session_state.plant_context)
-                    st.session_state.chat_history.append({'role': 'assistant', 'content': response})
-                    st.rerun()
-    
-    # Clear Chat
-    if len(st.session_state.chat_history) > 0:
-        if st.button("🗑️ Clear Chat"):
-            st.session_state.chat_history = []
-            st.rerun()
+    chat_panel()
 
 # ----------------------------------
 # My Plants Page
@@ -939,20 +1350,28 @@ elif app_mode == "📚 My Plants":
     if not st.session_state.detection_history:
         st.info("🌱 No plants identified yet. Go to Plant Detection!")
     else:
-        st.markdown(f"### Total: {len(st.session_state.detection_history)}")
+        history = st.session_state.detection_history
+        total = len(history)
+        st.markdown(f"### Total: {total}")
+        
+        if total == DETECTION_HISTORY_LIMIT:
+            st.caption(f"Only the latest {DETECTION_HISTORY_LIMIT} identifications are kept.")
         
-        for record in reversed(st.session_state.detection_history):
-            with st.expander(f"🌿 {record['plant_name']} - {record['timestamp']}"):
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.write(f"**Plant:** {record['plant_name']}")
-                    st.write(f"**Scientific:** {record.get('scientific_name', 'N/A')}")
-                with col2:
-                    st.write(f"**Date:** {record['timestamp']}")
+        # One table element (newest first) instead of an expander and columns per record
+        st.dataframe(
+            [
+                {
+                    "Plant": record['plant_name'],
+                    "Scientific Name": record.get('scientific_name', 'N/A'),
+                    "Date": record['timestamp']
+                }
+                for record in reversed(history)
+            ],
+            use_container_width=True,
+            hide_index=True
+        )
         
-        if st.button("🗑️ Clear History"):
-            st.session_state.detection_history = []
-            st.rerun()
+        st.button("🗑️ Clear History", on_click=clear_detection_history)
 
 
 